@@ -1,92 +1,386 @@
 # app.py  –  full, self-contained URL shortener
 # Works on Windows 7 + Python 3.8  (Flask 2.2.5 / Werkzeug 2.2.3)
 
-from flask import Flask, request, redirect, render_template_string
+from flask import Flask, Response, request, redirect
+import click
+from werkzeug.urls import iri_to_uri
+from jinja2 import Environment, BaseLoader
 import sqlite3
+import os
 import string
-import random
-from datetime import datetime
+import secrets
+import queue
+import threading
+import atexit
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
 app = Flask(__name__)
 DB_NAME = "urls.db"
+POOL_SIZE = 8
+CLEANUP_INTERVAL = 60  # seconds between expired-link purges
+CLEANUP_BATCH = 4096   # rows per DELETE so the writer lock is released often
+CLICK_FLUSH_INTERVAL = 2  # seconds between writes of buffered click counts
+WAL_CHECKPOINT_INTERVAL = 300  # seconds between WAL truncations
+RESOLVE_TTL = 5  # max seconds a cached short code lookup is trusted
+_ALPHABET = (string.ascii_letters + string.digits).encode()
 
 # ---------- AUTO-DETECT BASE URL ----------
 def get_base_url():
     """Return the protocol + host the user is currently using."""
-    if request:
-        return f"{request.scheme}://{request.host}"
-    return "http://localhost:5000"
+    return f"{request.scheme}://{request.host}"
 
 # ---------- DATABASE ----------
+_pool = queue.Queue(maxsize=POOL_SIZE)
+
+def _connect():
+    """Open a connection with the per-connection PRAGMAs applied."""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB: page reads become memcpy
+    return conn
+
+def _get_conn():
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+def _put_conn(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def db():
+    """Borrow a pooled autocommit connection for the duration of the block."""
+    conn = _get_conn()
+    try:
+        yield conn
+    finally:
+        _put_conn(conn)
+
+URLS_DDL = """
+CREATE TABLE IF NOT EXISTS urls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    long_url TEXT NOT NULL,
+    short_code TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    clicks INTEGER DEFAULT 0,
+    expiration INTEGER
+)
+"""
+
+EXPIRATION_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS idx_urls_expiration "
+    "ON urls(expiration) WHERE expiration IS NOT NULL"
+)
+
+# PRAGMA user_version value recording that NOCASE was skipped for clashing codes
+_NOCASE_SKIPPED = 1
+
+def _case_clashes(conn):
+    """Return groups of short codes that differ only by case."""
+    return [row[0] for row in conn.execute(
+        "SELECT group_concat(short_code, ', ') FROM urls "
+        "GROUP BY short_code COLLATE NOCASE HAVING COUNT(*) > 1"
+    )]
+
+def _migrate_schema(conn, retry_nocase=False):
+    """Rebuild a table created by an older version of this app.
+
+    Older tables stored expiration as TEXT dates and compared short codes
+    case-sensitively. If existing codes differ only by case, NOCASE would
+    break their uniqueness, so the table keeps binary comparison; that is
+    warned about once and remembered in user_version. Rename the clashes,
+    then run `flask --app url migrate-short-codes` (retry_nocase=True).
+    Returns the clashing groups that blocked NOCASE, if any.
+    """
+    # lock first: workers starting together must not both see the old schema
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cols = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(urls)")}
+        text_expiration = cols.get("expiration", "").upper() == "TEXT"
+        table_sql, = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'urls'"
+        ).fetchone()
+        nocase = "COLLATE NOCASE" in table_sql.upper()
+        skipped = conn.execute("PRAGMA user_version").fetchone()[0] == _NOCASE_SKIPPED
+        want_nocase = not nocase and (retry_nocase or not skipped)
+
+        clashes = _case_clashes(conn) if want_nocase else []
+        if clashes:
+            want_nocase = False
+            if not skipped:
+                app.logger.warning(
+                    "short codes differing only by case exist (%s); lookups stay "
+                    "case-sensitive. Rename them, then run "
+                    "`flask --app url migrate-short-codes`.", "; ".join(clashes)
+                )
+                conn.execute(f"PRAGMA user_version = {_NOCASE_SKIPPED}")
+
+        if text_expiration or want_nocase:
+            ddl = URLS_DDL if nocase or want_nocase else URLS_DDL.replace(" COLLATE NOCASE", "")
+            expiration = "CAST(strftime('%s', expiration) AS INTEGER)" if text_expiration else "expiration"
+            conn.execute("ALTER TABLE urls RENAME TO urls_old")
+            conn.execute(ddl)
+            conn.execute(f"""
+            INSERT INTO urls (id, long_url, short_code, clicks, expiration)
+            SELECT id, long_url, short_code, clicks, {expiration}
+            FROM urls_old
+            """)
+            # dropping urls_old took its indexes with it
+            conn.execute("DROP TABLE urls_old")
+            conn.execute(EXPIRATION_INDEX_DDL)
+            if want_nocase:
+                conn.execute("PRAGMA user_version = 0")
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    return clashes
+
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS urls (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            long_url TEXT NOT NULL,
-            short_code TEXT UNIQUE NOT NULL,
-            clicks INTEGER DEFAULT 0,
-            expiration TEXT
+    # closed rather than pooled: a preloading server forks after this runs,
+    # and SQLite connections must not be carried across fork()
+    conn = _connect()
+    try:
+        conn.execute(URLS_DDL)
+        _migrate_schema(conn)
+        conn.execute(EXPIRATION_INDEX_DDL)
+        # WAL is stored in the db file, so later connections inherit it
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+
+@app.cli.command("migrate-short-codes")
+def migrate_short_codes():
+    """Make short codes case-insensitive once case clashes are renamed."""
+    with db() as conn:
+        clashes = _migrate_schema(conn, retry_nocase=True)
+    if clashes:
+        for group in clashes:
+            click.echo(f"clash: {group}")
+        raise click.ClickException(
+            "rename all but one code in each group, e.g. "
+            "UPDATE urls SET short_code = 'new' WHERE short_code = 'old', then rerun"
         )
-        """)
+    click.echo("short codes are case-insensitive")
+
+def _is_web_url(url):
+    """True for http(s) links; anything else (javascript:, data:) is refused."""
+    return urlsplit(url.strip()).scheme.lower() in ("http", "https")
+
+def _date_to_epoch(value):
+    """Turn a form date (YYYY-MM-DD) into UTC epoch seconds at midnight."""
+    dt = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def _epoch_to_date(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+# one shared string so pooled connections reuse their cached prepared statement;
+# id is the rowid, so this is a reverse walk of the table b-tree with no sort
+HISTORY_SQL = "SELECT short_code, clicks, expiration FROM urls ORDER BY id DESC LIMIT 10"
 
 def generate_short_code(length=6):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    # one entropy read; the slight modulo bias is irrelevant for short codes
+    return bytes(_ALPHABET[b % len(_ALPHABET)] for b in secrets.token_bytes(length)).decode()
 
 def cleanup_expired():
-    now = datetime.utcnow().isoformat()
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute(
-            "DELETE FROM urls WHERE expiration IS NOT NULL AND expiration <= ?",
+    now = int(time.time())
+    with db() as conn:
+        # cheap read first so no write transaction starts when nothing expired
+        if not conn.execute(
+            "SELECT 1 FROM urls WHERE expiration IS NOT NULL AND expiration <= ? LIMIT 1",
             (now,)
-        )
+        ).fetchone():
+            return
+        # autocommit: each batch is its own short transaction
+        while conn.execute(
+            "DELETE FROM urls WHERE rowid IN ("
+            "SELECT rowid FROM urls WHERE expiration IS NOT NULL AND expiration <= ? LIMIT ?)",
+            (now, CLEANUP_BATCH)
+        ).rowcount:
+            pass
+    _resolve.cache_clear()
+
+def resolve(short_code):
+    """Return (stored_code, long_url, expiration); raises KeyError if unknown.
+
+    Lookups are cached for at most RESOLVE_TTL seconds. Deletes and purges
+    clear this process's cache, but other workers only notice once their
+    entry ages out.
+    """
+    return _resolve(short_code, int(time.monotonic() // RESOLVE_TTL))
+
+@lru_cache(maxsize=10_000)
+def _resolve(short_code, ttl_bucket):
+    # ttl_bucket is only part of the cache key; a new bucket forces a re-read.
+    # Misses raise instead of returning None so they are never cached and a
+    # code created later (possibly by another worker) resolves immediately.
+    with db() as conn:
+        row = conn.execute(
+            "SELECT short_code, long_url, expiration FROM urls WHERE short_code = ?",
+            (short_code,)
+        ).fetchone()
+    if row is None:
+        raise KeyError(short_code)
+    return row
+
+# ---------- CLICK COUNTING ----------
+_click_buf = Counter()
+_click_lock = threading.Lock()
+
+# keyed by the code as stored, not as typed, so the flush UPDATE matches the
+# row whether or not the table has NOCASE collation
+def record_click(short_code):
+    with _click_lock:
+        _click_buf[short_code] += 1
+
+def pending_clicks(short_code):
+    with _click_lock:
+        return _click_buf[short_code]
+
+def flush_clicks():
+    """Write buffered clicks to the database in one transaction."""
+    with _click_lock:
+        if not _click_buf:
+            return
+        pending = dict(_click_buf)
+        _click_buf.clear()
+    try:
+        with db() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE urls SET clicks = clicks + ? WHERE short_code = ?",
+                [(n, code) for code, n in pending.items()]
+            )
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        # put the counts back so the next flush retries them
+        with _click_lock:
+            _click_buf.update(pending)
+        raise
+
+atexit.register(flush_clicks)
+
+# ---------- BACKGROUND JOBS ----------
+_jobs_stop = threading.Event()
+
+def _run_periodically(job, interval):
+    while True:
+        try:
+            job()
+        except Exception:
+            # never let one failure kill the thread; clicks would pile up unflushed
+            app.logger.exception("%s failed", job.__name__)
+        if _jobs_stop.wait(interval):
+            return
+
+def checkpoint_wal():
+    """Fold the WAL back into the db file and truncate it so it can't grow unbounded."""
+    with db() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def start_background_jobs():
+    """Run purges, click flushes and WAL checkpoints off the request path."""
+    for job, interval in ((cleanup_expired, CLEANUP_INTERVAL),
+                          (flush_clicks, CLICK_FLUSH_INTERVAL),
+                          (checkpoint_wal, WAL_CHECKPOINT_INTERVAL)):
+        threading.Thread(target=_run_periodically, args=(job, interval),
+                         name=f"xq-{job.__name__}", daemon=True).start()
+
+_jobs_pid = None
+_jobs_lock = threading.Lock()
+
+@app.before_request
+def _ensure_background_jobs():
+    """Start the jobs in the process that serves requests, once per PID.
+
+    Threads don't survive fork(), so starting them at import would leave
+    workers of a preloading server (gunicorn --preload, uwsgi without
+    lazy-apps) with none.
+    """
+    global _jobs_pid
+    if _jobs_pid == os.getpid():
+        return
+    with _jobs_lock:
+        if _jobs_pid != os.getpid():
+            start_background_jobs()
+            _jobs_pid = os.getpid()
+
+def _reset_after_fork():
+    global _pool, _jobs_lock
+    # the parent's pooled connections must not be used in the child
+    _pool = queue.Queue(maxsize=POOL_SIZE)
+    _jobs_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):  # POSIX only
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 # ---------- ROUTES ----------
 @app.route("/", methods=["GET", "POST"])
 def index():
-    cleanup_expired()
     error = None
     short_url = None
-    base_url = get_base_url()
-
-    if request.method == "POST":
-        long_url = request.form["long_url"]
-        custom_code = request.form.get("custom_code")
-        expiration_date = request.form.get("expiration_date")
+    created = request.args.get("created")
+    if created:
+        short_url = f"{get_base_url()}/{created}"
 
-        short_code = custom_code if custom_code else generate_short_code()
-        expiration = expiration_date if expiration_date else None
+    with db() as conn:
+        if request.method == "POST":
+            long_url = request.form["long_url"]
+            custom_code = request.form.get("custom_code")
+            expiration_date = request.form.get("expiration_date")
 
-        try:
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "INSERT INTO urls (long_url, short_code, expiration) VALUES (?, ?, ?)",
-                    (long_url, short_code, expiration)
-                )
-            return redirect("/?created=" + short_code)
-        except sqlite3.IntegrityError:
-            error = "Custom code already exists."
+            short_code = custom_code if custom_code else generate_short_code()
+            expiration = None
+            if not _is_web_url(long_url):
+                error = "Only http:// and https:// links can be shortened."
+            elif expiration_date:
+                try:
+                    expiration = _date_to_epoch(expiration_date)
+                except ValueError:
+                    error = "Invalid expiration date."
 
-    created = request.args.get("created")
-    if created:
-        short_url = f"{base_url}/{created}"
+            if error is None:
+                try:
+                    # take the write lock up front so WAL readers never need an upgrade
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute(
+                        "INSERT INTO urls (long_url, short_code, expiration) VALUES (?, ?, ?)",
+                        (long_url, short_code, expiration)
+                    )
+                    conn.execute("COMMIT")
+                    return redirect("/?created=" + short_code)
+                except sqlite3.IntegrityError:
+                    conn.execute("ROLLBACK")
+                    error = "Custom code already exists."
 
-    with sqlite3.connect(DB_NAME) as conn:
-        history = conn.execute(
-            "SELECT short_code, long_url, clicks, expiration FROM urls ORDER BY id DESC LIMIT 10"
-        ).fetchall()
+        history = conn.execute(HISTORY_SQL).fetchall()
 
-    return render_template_string(TEMPLATE,
-                                  short_url=short_url,
-                                  history=history,
-                                  error=error)
+    return _TEMPLATE.render(short_url=short_url,
+                            history=history,
+                            error=error)
 
 # ---------- DELETE ----------
 @app.route("/delete", methods=["POST"])
 def delete_url():
     short_code = request.form["short_code"]
-    with sqlite3.connect(DB_NAME) as conn:
+    with db() as conn:
         conn.execute("DELETE FROM urls WHERE short_code = ?", (short_code,))
+    _resolve.cache_clear()
     return redirect("/")
 
 # ---------- REDIRECT + PREVIEW ----------
@@ -94,28 +388,35 @@ def delete_url():
 def redirect_url(short_code):
     preview = short_code.endswith("+")
     short_code = short_code[:-1] if preview else short_code
+    now = int(time.time())
 
-    cleanup_expired()
-
-    with sqlite3.connect(DB_NAME) as conn:
-        cur = conn.execute(
-            "SELECT long_url, clicks FROM urls WHERE short_code = ?",
-            (short_code,)
-        )
-        row = cur.fetchone()
+    if preview:
+        with db() as conn:
+            # expired rows may linger until the next background purge
+            row = conn.execute(
+                "SELECT short_code, long_url, clicks FROM urls WHERE short_code = ? "
+                "AND (expiration IS NULL OR expiration > ?)",
+                (short_code, now)
+            ).fetchone()
         if not row:
             return "URL not found", 404
 
-        long_url, clicks = row
+        stored_code, long_url, clicks = row
+        clicks += pending_clicks(stored_code)
+        return _PREVIEW.render(long_url=long_url, clicks=clicks, short_code=short_code,
+                               linkable=_is_web_url(long_url))
 
-        if preview:
-            return PREVIEW_TEMPLATE.format(long_url=long_url, clicks=clicks, short_code=short_code)
+    try:
+        stored_code, long_url, expiration = resolve(short_code)
+    except KeyError:
+        return "URL not found", 404
+    if expiration is not None and expiration <= now:
+        return "URL not found", 404
 
-        conn.execute(
-            "UPDATE urls SET clicks = clicks + 1 WHERE short_code = ?",
-            (short_code,)
-        )
-        return redirect(long_url)
+    record_click(stored_code)
+    # bare 302: browsers only need Location, not redirect()'s HTML body
+    return Response(status=302, headers={"Location": iri_to_uri(long_url),
+                                         "Cache-Control": "private, no-store"})
 
 # ---------- HTML TEMPLATES ----------
 TEMPLATE = """
@@ -183,8 +484,8 @@ TEMPLATE = """
                 <a href="/{{ h[0] }}" target="_blank">{{ h[0] }}</a>
                 <a href="/{{ h[0] }}+" title="Preview">+</a>
             </td>
-            <td>{{ h[2] }}</td>
-            <td>{{ h[3] if h[3] else "Never" }}</td>
+            <td>{{ h[1] }}</td>
+            <td>{{ h[2]|epoch_date if h[2] else "Never" }}</td>
             <td>
                 <form method="post" action="/delete" style="display:inline;">
                     <input type="hidden" name="short_code" value="{{ h[0] }}">
@@ -217,15 +518,39 @@ display:flex;align-items:center;justify-content:center;height:100vh;">
 <div style="border:1px solid #ccc;padding:25px;width:420px;text-align:center;">
 <h2 style="color:#c00;">Link Preview</h2>
 <p>Redirects to:</p>
-<a href="{long_url}" style="color:#c00;" target="_blank">{long_url}</a>
-<p>Clicks: {clicks}</p>
-<a href="/{short_code}">
+{% if linkable %}<a href="{{ long_url }}" style="color:#c00;" target="_blank">{{ long_url }}</a>
+{% else %}<span style="color:#c00;">{{ long_url }}</span>{% endif %}
+<p>Clicks: {{ clicks }}</p>
+<a href="/{{ short_code }}">
 <button style="margin-top:15px;padding:8px 16px;">Continue →</button>
 </a>
 </div></body></html>
 """
 
+# compiled once at import instead of on every render
+_env = Environment(loader=BaseLoader(), autoescape=True)
+_env.filters["epoch_date"] = _epoch_to_date
+_TEMPLATE = _env.from_string(TEMPLATE)
+_PREVIEW = _env.from_string(PREVIEW_TEMPLATE)
+
 # ---------- START ----------
+_initialized = False
+_init_lock = threading.Lock()
+
+def setup():
+    """Create the schema once per process.
+
+    Runs at import so WSGI servers (gunicorn, uwsgi) get it too. Background
+    jobs start on the first request instead; see _ensure_background_jobs().
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        init_db()
+        _initialized = True
+
+setup()
+
 if __name__ == "__main__":
-    init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file